@@ -6,11 +6,14 @@
 */
 module tb ();
     // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+    // Dumping slows the simulation down, so it is only enabled with VCD=yes.
+`ifdef DUMP_VCD
     initial begin
         $dumpfile("tb.vcd");
         $dumpvars(0, tb);
         #1;
     end
+`endif
     
     // Wire up the inputs and outputs:
     reg clk;
@@ -34,7 +37,13 @@ module tb ();
         .rst_n  (rst_n)     // not reset
     );
     
-    // Clock generation is controlled by cocotb
+    // All outputs in one vector, so the test can sample them with one read
+    wire [23:0] dbg_bus = {uio_oe, uio_out, uo_out};
+    
+    // Free-running 10 ns clock. Generating it here instead of with a cocotb
+    // Clock keeps the per-edge toggling out of Python.
+    always #5 clk = ~clk;
+
     // Initial values to prevent X states
     initial begin
         clk = 0;
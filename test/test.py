@@ -1,94 +1,109 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
-import cocotb
-from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge
+# test_gds_connectivity is a long diagnostic and is skipped by default.
+# Run it with COCOTB_RUN_DIAGNOSTIC=1, e.g. `make COCOTB_RUN_DIAGNOSTIC=1`.
+
 import os
 
-# Set environment variable to handle X values
-os.environ['COCOTB_RESOLVE_X'] = '0'
+import cocotb
+from cocotb.binary import BinaryValue
+from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge, Timer
 
-@cocotb.test()
+RUN_DIAGNOSTIC = os.environ.get("COCOTB_RUN_DIAGNOSTIC", "0") == "1"
+
+@cocotb.test(skip=not RUN_DIAGNOSTIC)
 async def test_gds_connectivity(dut):
     """Comprehensive GDS connectivity test to diagnose Sky130 issues"""
     dut._log.info("=== COMPREHENSIVE GDS CONNECTIVITY DIAGNOSTIC ===")
     
-    # Helper function to safely read signals and detect X states
-    def analyze_signal(signal, signal_name):
-        """Analyze a signal and return both value and X state info"""
-        try:
-            raw_value = signal.value
-            if 'x' in str(raw_value).lower() or 'z' in str(raw_value).lower():
-                dut._log.error(f"❌ {signal_name}: Contains X/Z values: {raw_value}")
-                return 0, True  # value, has_x
-            else:
-                int_value = int(raw_value)
-                dut._log.info(f"✅ {signal_name}: Clean value: 0x{int_value:02x}")
-                return int_value, False
-        except (ValueError, TypeError) as e:
-            dut._log.error(f"❌ {signal_name}: Read error: {e}")
-            return 0, True
+    # Helper function to detect X states in a sampled value
+    def analyze_signal(bstr, signal_name):
+        """Analyze a sampled binary string and return both value and X state info"""
+        value = BinaryValue(bstr, n_bits=8)
+        if not value.is_resolvable:
+            dut._log.error("❌ %s: Contains X/Z values: %s", signal_name, bstr)
+            return 0, True  # value, has_x
+        int_value = value.integer
+        dut._log.info("✅ %s: Clean value: 0x%02x", signal_name, int_value)
+        return int_value, False
 
     # STEP 1: Initial signal analysis before any setup
     dut._log.info("=== STEP 1: INITIAL SIGNAL STATE ANALYSIS ===")
     
-    # Check all signals in their natural state
-    initial_signals = {
-        'uo_out': dut.uo_out,
-        'uio_out': dut.uio_out,
-        'uio_oe': dut.uio_oe
-    }
+    # Look up the handles once instead of on every access
+    clk = dut.clk
+    rst_n = dut.rst_n
+    ena = dut.ena
+    ui_in = dut.ui_in
+    uio_in = dut.uio_in
+    dbg_bus = dut.dbg_bus
+    
+    # Check all signals in their natural state. tb.v packs them as
+    # dbg_bus = {uio_oe, uio_out, uo_out}; these are their binstr slices.
+    initial_signals = (
+        ('uo_out', slice(16, 24)),
+        ('uio_out', slice(8, 16)),
+        ('uio_oe', slice(0, 8)),
+    )
+    
+    def read_all():
+        """Read every output with a single access to dbg_bus"""
+        bstr = dbg_bus.value.binstr
+        return [(name, bstr[bits]) for name, bits in initial_signals]
+    
+    def analyze_all(samples, suffix=""):
+        """Analyze samples taken with read_all()"""
+        return [(name, *analyze_signal(bstr, name + suffix)) for name, bstr in samples]
+    
+    def sample_all(suffix=""):
+        """Read every output at once, then analyze them"""
+        return analyze_all(read_all(), suffix)
     
     x_count = 0
-    for name, signal in initial_signals.items():
-        value, has_x = analyze_signal(signal, name)
+    for name, value, has_x in sample_all():
         if has_x:
             x_count += 1
     
     if x_count > 0:
-        dut._log.error(f"❌ CRITICAL: {x_count}/3 output signals have X states BEFORE any setup!")
-        dut._log.error("This suggests fundamental GDS connectivity issues:")
-        dut._log.error("1. Output pins not properly connected to internal logic")
-        dut._log.error("2. Power/ground connectivity issues in GDS")
-        dut._log.error("3. Missing or broken vias in the layout")
-    
-    # STEP 2: Setup basic clock and minimal initialization
+        dut._log.error("\n".join([
+            "❌ CRITICAL: %d/3 output signals have X states BEFORE any setup!",
+            "This suggests fundamental GDS connectivity issues:",
+            "1. Output pins not properly connected to internal logic",
+            "2. Power/ground connectivity issues in GDS",
+            "3. Missing or broken vias in the layout",
+        ]), x_count)
+    
+    # STEP 2: Minimal initialization (clock is generated in tb.v)
     dut._log.info("=== STEP 2: CLOCK AND BASIC SETUP ===")
     
-    # Start clock
-    clock = Clock(dut.clk, 10, units="ns")
-    cocotb.start_soon(clock.start())
-    
     # Set all inputs to known states
-    dut.ena.value = 1
-    dut.ui_in.value = 0
-    dut.uio_in.value = 0
-    dut.rst_n.value = 0  # Assert reset
+    ena.value = 1
+    ui_in.value = 0
+    uio_in.value = 0
+    rst_n.value = 0  # Assert reset
     
-    await ClockCycles(dut.clk, 5)
+    await ClockCycles(clk, 5)
     
     # Check signals during reset
     dut._log.info("--- During Reset ---")
     reset_x_count = 0
-    for name, signal in initial_signals.items():
-        value, has_x = analyze_signal(signal, f"{name}_during_reset")
+    for name, value, has_x in sample_all("_during_reset"):
         if has_x:
             reset_x_count += 1
     
     # STEP 3: Release reset and check for response
     dut._log.info("=== STEP 3: RESET RELEASE TEST ===")
     
-    dut.rst_n.value = 1  # Release reset
-    await ClockCycles(dut.clk, 10)  # Give time for reset to propagate
+    rst_n.value = 1  # Release reset
+    await ClockCycles(clk, 10)  # Give time for reset to propagate
     
     # Check signals after reset release
     dut._log.info("--- After Reset Release ---")
     post_reset_values = {}
     post_reset_x_count = 0
     
-    for name, signal in initial_signals.items():
-        value, has_x = analyze_signal(signal, f"{name}_post_reset")
+    for name, value, has_x in sample_all("_post_reset"):
         post_reset_values[name] = value
         if has_x:
             post_reset_x_count += 1
@@ -105,72 +120,81 @@ async def test_gds_connectivity(dut):
     ]
     
     response_count = 0
-    
-    for i, pattern in enumerate(test_patterns):
-        dut._log.info(f"--- Test Pattern {i+1}: {pattern['name']} ---")
-        
-        # Apply pattern
-        dut.ui_in.value = pattern["ui_in"]
-        if "uio_in" in pattern:
-            dut.uio_in.value = pattern["uio_in"]
-        else:
-            dut.uio_in.value = 0
+    last_uio_in = 0  # driven to 0 in STEP 2
+    
+    # Apply every pattern first, only capturing the raw outputs, so that
+    # nothing but stimulus and sampling runs between the awaits
+    pattern_samples = []
+    for pattern in test_patterns:
+        # Apply pattern, skipping the uio_in write when it is unchanged
+        ui_in.value = pattern["ui_in"]
+        pattern_uio_in = pattern.get("uio_in", 0)
+        if pattern_uio_in != last_uio_in:
+            uio_in.value = pattern_uio_in
+            last_uio_in = pattern_uio_in
             
-        await ClockCycles(dut.clk, 5)
+        await ClockCycles(clk, 5)
+        pattern_samples.append(read_all())
+    
+    # Check the response to each pattern
+    for i, (pattern, samples) in enumerate(zip(test_patterns, pattern_samples)):
+        dut._log.info("--- Test Pattern %d: %s ---", i + 1, pattern["name"])
         
-        # Check response
         current_values = {}
         pattern_x_count = 0
         pattern_changed = False
         
-        for name, signal in initial_signals.items():
-            value, has_x = analyze_signal(signal, f"{name}_{pattern['name']}")
+        for name, value, has_x in analyze_all(samples, "_" + pattern["name"]):
             current_values[name] = value
             
             if has_x:
                 pattern_x_count += 1
             elif value != post_reset_values.get(name, 0):
                 pattern_changed = True
-                dut._log.info(f"🔄 {name} changed from {post_reset_values.get(name, 0)} to {value}")
+                dut._log.info("🔄 %s changed from %d to %d", name, post_reset_values.get(name, 0), value)
         
         if pattern_changed and pattern_x_count == 0:
             response_count += 1
-            dut._log.info(f"✅ Pattern {pattern['name']}: System responded correctly!")
+            dut._log.info("✅ Pattern %s: System responded correctly!", pattern["name"])
         elif pattern_x_count > 0:
-            dut._log.error(f"❌ Pattern {pattern['name']}: Still has {pattern_x_count} X signals")
+            dut._log.error("❌ Pattern %s: Still has %d X signals", pattern["name"], pattern_x_count)
         else:
-            dut._log.warning(f"⚠️ Pattern {pattern['name']}: No response detected")
+            dut._log.warning("⚠️ Pattern %s: No response detected", pattern["name"])
     
     # STEP 5: ENA signal test
-    dut._log.info("=== STEP 5: ENA SIGNAL CONNECTIVITY TEST ===")
-    
-    # Test with ena = 0
-    dut.ena.value = 0
-    await ClockCycles(dut.clk, 5)
-    
-    ena_off_values = {}
+    # Toggling ENA only helps narrow down a failure, so skip it when the
+    # reset and pattern steps were all clean
     ena_off_x_count = 0
-    for name, signal in initial_signals.items():
-        value, has_x = analyze_signal(signal, f"{name}_ena_off")
-        ena_off_values[name] = value
-        if has_x:
-            ena_off_x_count += 1
-    
-    # Test with ena = 1
-    dut.ena.value = 1
-    await ClockCycles(dut.clk, 5)
-    
-    ena_on_values = {}
     ena_on_x_count = 0
     ena_responded = False
     
-    for name, signal in initial_signals.items():
-        value, has_x = analyze_signal(signal, f"{name}_ena_on")
-        ena_on_values[name] = value
-        if has_x:
-            ena_on_x_count += 1
-        elif value != ena_off_values.get(name, 0):
-            ena_responded = True
+    if reset_x_count or post_reset_x_count or response_count < len(test_patterns):
+        dut._log.info("=== STEP 5: ENA SIGNAL CONNECTIVITY TEST ===")
+        
+        # Test with ena = 0
+        ena.value = 0
+        await ClockCycles(clk, 5)
+        
+        ena_off_values = {}
+        for name, value, has_x in sample_all("_ena_off"):
+            ena_off_values[name] = value
+            if has_x:
+                ena_off_x_count += 1
+        
+        # Test with ena = 1
+        ena.value = 1
+        await ClockCycles(clk, 5)
+        
+        ena_on_values = {}
+        
+        for name, value, has_x in sample_all("_ena_on"):
+            ena_on_values[name] = value
+            if has_x:
+                ena_on_x_count += 1
+            elif value != ena_off_values.get(name, 0):
+                ena_responded = True
+    else:
+        dut._log.info("=== STEP 5: ENA SIGNAL CONNECTIVITY TEST (skipped, no issues found) ===")
     
     # STEP 6: Final diagnosis and recommendations
     dut._log.info("=== STEP 6: FINAL DIAGNOSIS ===")
@@ -188,23 +212,26 @@ async def test_gds_connectivity(dut):
             dut._log.info("This suggests a logic design issue, not GDS connectivity")
             
     else:
-        dut._log.error("❌ MAJOR CONNECTIVITY ISSUES DETECTED")
-        dut._log.error(f"Total X state occurrences: {total_x_states}")
-        dut._log.error("")
-        dut._log.error("RECOMMENDED FIXES:")
-        dut._log.error("1. Check GDS viewer for:")
-        dut._log.error("   - Broken metal connections")
-        dut._log.error("   - Missing vias between metal layers")
-        dut._log.error("   - Disconnected output pins")
-        dut._log.error("")
-        dut._log.error("2. Verify synthesis didn't optimize away logic:")
-        dut._log.error("   - Check synthesis logs for warnings")
-        dut._log.error("   - Ensure all outputs are registered")
-        dut._log.error("   - Verify no logic was optimized out")
-        dut._log.error("")
-        dut._log.error("3. Check top-level connections in info.yaml")
-        dut._log.error("4. Verify power and ground routing in GDS")
-        dut._log.error("")
+        # One log call for the whole block instead of one per line
+        dut._log.error("\n".join([
+            "❌ MAJOR CONNECTIVITY ISSUES DETECTED",
+            "Total X state occurrences: %d",
+            "",
+            "RECOMMENDED FIXES:",
+            "1. Check GDS viewer for:",
+            "   - Broken metal connections",
+            "   - Missing vias between metal layers",
+            "   - Disconnected output pins",
+            "",
+            "2. Verify synthesis didn't optimize away logic:",
+            "   - Check synthesis logs for warnings",
+            "   - Ensure all outputs are registered",
+            "   - Verify no logic was optimized out",
+            "",
+            "3. Check top-level connections in info.yaml",
+            "4. Verify power and ground routing in GDS",
+            "",
+        ]), total_x_states)
         
         # Don't fail the test - let it complete to give full diagnostic info
         dut._log.error("GDS has fundamental connectivity issues that must be fixed")
@@ -228,28 +255,30 @@ async def test_simple_functionality(dut):
     """Simple functionality test assuming connectivity is working"""
     dut._log.info("=== SIMPLE FUNCTIONALITY TEST ===")
     
-    # Basic setup
-    clock = Clock(dut.clk, 10, units="ns")
-    cocotb.start_soon(clock.start())
+    clk = dut.clk
+    rst_n = dut.rst_n
+    ena = dut.ena
+    ui_in = dut.ui_in
+    uo_out = dut.uo_out
     
-    dut.ena.value = 1
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 10)
+    # Basic setup (clock is generated in tb.v)
+    ena.value = 1
+    rst_n.value = 0
+    # Plain delays (10 and 5 clock periods): nothing is sampled before the
+    # next write, so one Timer callback replaces a callback per clock edge
+    await Timer(100, units="ns")
     
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    rst_n.value = 1
+    await Timer(50, units="ns")
     
     # Test power on
-    dut.ui_in.value = 0b00001000  # PLC power on
-    await ClockCycles(dut.clk, 5)
-    
-    try:
-        output = int(dut.uo_out.value)
-        if output & 0x01:
-            dut._log.info("✅ Basic power control working")
-        else:
-            dut._log.warning("⚠️ Power control not responding")
-    except:
-        dut._log.error("❌ Cannot read output - connectivity issue")
+    ui_in.value = 0b00001000  # PLC power on
+    await ClockCycles(clk, 5)
+    
+    # This is the default regression test, so fail rather than just log
+    output = uo_out.value
+    assert output.is_resolvable, f"❌ Cannot read output - connectivity issue: {output.binstr}"
+    assert output.integer & 0x01, f"⚠️ Power control not responding: uo_out=0x{output.integer:02x}"
+    dut._log.info("✅ Basic power control working")
     
     dut._log.info("Simple functionality test completed")